@@ -7,6 +7,7 @@
 
 # Extract public key from an authenticode certificate to C source.
 # Usage: getkeys.py < input_file.json > output_file.c
+# Requires Python 3 and the asn1crypto package.
 #
 # Input json file has format:
 # {
@@ -15,115 +16,71 @@
 # }
 
 import base64
+import functools
+import io
 import json
 import os
 import re
-import subprocess
 import sys
 import time
 
+import asn1crypto.x509 as x509
+
 # Load keyinfo library
 keyinfo_dir = os.getenv('KEYINFO_DIR', None)
 if keyinfo_dir:
     sys.path.append(keyinfo_dir)
     from lib import keyinfo
-    get_pem = keyinfo.GetPem
+    get_pem = functools.lru_cache(maxsize=None)(keyinfo.GetPem)
 else:
+    @functools.lru_cache(maxsize=None)
     def get_pem(key):
-        return "../localkeys/%s.pem" % key
+        return os.path.join('..', 'localkeys', '%s.pem' % key)
 
 hash_algs = dict(
-    sha1WithRSAEncryption='SHA256',
-    sha256WithRSAEncryption='SHA256',
-    sha512WithRSAEncryption='SHA512'
+    sha1_rsa='SHA256',
+    sha256_rsa='SHA256',
+    sha512_rsa='SHA512'
 )
 
-class asn1line:
-    def __init__(self, line):
-        # Parse lines like
-        #  123:d=2 hl=2 l=111 prim: INTEGER        :1234
-        #  234:d=9 hl=1 l=  1 cons: foo [ 3 ]
-        m = re.match(r'\s*(\d+):d=\s*(\d+)\s+hl=\s*(\d+)\s+l=\s*(\d+)\s+'
-                      '(\S+):\s+(.{1,18})\s*:?(.*)', line)
-        if m:
-            self.offset = int(m.group(1))
-            self.d = int(m.group(2))
-            self.hl = int(m.group(3))
-            self.l = int(m.group(4))
-            self.prim = m.group(5)
-            self.op = m.group(6).strip()
-            self.param = m.group(7).strip()
-        else:
-            raise ValueError("Unexpected asn1parse output %s" % line)
-
-
-def parse_der(data):
-    proc = subprocess.Popen([os.getenv("HOST_OPENSSL", "openssl"),
-                             "asn1parse", "-inform", "der"],
-                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    (out, err) = proc.communicate(data)
-    if proc.returncode != 0:
-        raise ValueError("asn1parse failed with error code %d" %
-                         proc.returncode)
-    return [asn1line(line) for line in out.decode('utf-8').splitlines()]
+# C string escape for each byte value
+hex_escapes = ['\\x%02x' % x for x in range(256)]
+
+# Base64 body of the first certificate in a PEM file
+pem_cert_re = re.compile(rb'-----BEGIN CERTIFICATE-----\r?\n(.+?)\r?\n'
+                         rb'-----END CERTIFICATE-----', re.DOTALL)
+
+def header_len(value):
+    """\
+    Return the length of the DER tag and length octets of an asn1crypto value.
+    """
+    return len(value.dump()) - len(value.contents)
 
 
 def get_cert(pem_file):
     """\
     Retrieve DER-encoded certificate from PEM file.
     """
-    with open(pem_file, 'rt') as f:
-        mode = 0
-        crt = []
-        for line in f:
-            if line.startswith('-----'):
-                if mode != 0 or line.startswith('-----BEGIN CERTIFICATE-----'):
-                    mode += 1
-                continue
-            if mode == 1:
-                crt.append(line.rstrip())
-    if mode < 2:
-         raise ValueError("Certificate was not found in %s" % pem_file)
-    return base64.b64decode(''.join(crt))
+    with open(pem_file, 'rb') as f:
+        m = pem_cert_re.search(f.read())
+    if m is None:
+        raise ValueError("Certificate was not found in %s" % pem_file)
+    return base64.b64decode(m.group(1))
 
 
-def process_key(output, key):
+@functools.lru_cache(maxsize=None)
+def load_cert(pem_file):
     """\
-    Extract a public key from a certificate, and format it as
-    RawRSAKey structure.
+    Extract a public key from a certificate.  Returns the DER-encoded
+    certificate and a dict of RawRSAKey fields locating the key in it.
+    Results are cached, since the same key may be listed more than once.
     """
-    pem_file = get_pem(key)
-    if pem_file is None:
-        raise ValueError("Key %s does not exist" % key)
     der = get_cert(pem_file)
+    args = {}
 
-    args = {
-        'key_name': key,
-    }
-
-    der_info = parse_der(der)
-
-    sigalg = None
-    last_object = None
-    key_loc = None
-    for tag in der_info:
-        if tag.op == 'OBJECT':
-            if sigalg is None:
-                sigalg = tag.param
-                if tag.d != 3:
-                    raise ValueError('Unexpected OID found')
-                continue
-            last_object = tag
-            continue
-        if tag.op == 'BIT STRING':
-            if last_object is None or tag.d + 1 != last_object.d:
-                raise ValueError('Found bit string without associated OID')
-            if last_object.param != 'rsaEncryption':
-                raise ValueError('Key is not RSA key')
-            key_loc = (tag.offset + tag.hl + 1, tag.l - 1)
-            break
-    if sigalg is None:
-        raise ValueError('Signature algorithm is not set')
+    cert = x509.Certificate.load(der)
+    tbs = cert['tbs_certificate']
+    sigalg = tbs['signature']['algorithm'].native
 
     # It is not necessarily true that certificate's signature algorithm
     # matches signing algorithm used by signing, but it holds true for
@@ -134,73 +91,89 @@ def process_key(output, key):
     except KeyError:
         raise ValueError('Unknown signature algorithm %s' % sigalg)
 
-    if key_loc is None:
-        raise ValueError('RSA public key not present in certificate')
-
-    key_der = der[key_loc[0]:key_loc[0] + key_loc[1]]
-
-    key_info = parse_der(key_der)
-
-    modulus_offset = None
-    modulus_length = None
-    exponent_offset = None
-    exponent_length = None
-    for tag in key_info:
-        if tag.op == 'INTEGER':
-            if modulus_offset is None:
-                modulus_offset = key_loc[0] + tag.offset + tag.hl
-                modulus_length = tag.l
-            else:
-                exponent_offset = key_loc[0] + tag.offset + tag.hl
-                exponent_length = tag.l
-                break;
-    if exponent_offset is None:
-        raise ValueError('RSA key does not contain modulus and exponent')
+    # Locate SubjectPublicKeyInfo by summing up the encoded lengths of
+    # the TBSCertificate fields that precede it.  The [0] version field
+    # is absent from v1 certificates, even though asn1crypto returns a
+    # default value for it.
+    fields = ['serial_number', 'signature', 'issuer', 'validity', 'subject']
+    if tbs.contents[0] == 0xa0:
+        fields.insert(0, 'version')
+    spki_offset = header_len(cert) + header_len(tbs)
+    for field in fields:
+        spki_offset += len(tbs[field].dump())
+    spki = tbs['subject_public_key_info']
+    if spki['algorithm']['algorithm'].native != 'rsa':
+        raise ValueError('Key is not RSA key')
+
+    # Skip the BIT STRING unused bits octet.
+    key_bits = spki['public_key']
+    key_offset = spki_offset + header_len(spki) + \
+                 len(spki['algorithm'].dump()) + header_len(key_bits) + 1
+
+    key_info = key_bits.parsed
+    modulus = key_info['modulus']
+    exponent = key_info['public_exponent']
+    modulus_offset = key_offset + header_len(key_info) + header_len(modulus)
+    modulus_length = len(modulus.contents)
+    exponent_offset = modulus_offset + modulus_length + header_len(exponent)
+    exponent_length = len(exponent.contents)
 
     if modulus_length < 2 or \
-       ord(der[modulus_offset]) != 0 or \
-       ord(der[modulus_offset + 1]) < 128:
+       der[modulus_offset] != 0 or \
+       der[modulus_offset + 1] < 128:
         raise ValueError('RSA modulus does not have %s valid bits' %
-                         (modulus_length - 1) * 8)
+                         ((modulus_length - 1) * 8))
 
     args['certLength'] = len(der)
     args['modulusStart'] = modulus_offset
     args['modulusLength'] = modulus_length
     args['exponentStart'] = exponent_offset
     args['exponentLength'] = exponent_length
+    return der, args
 
-    cert_rows = []
-    for x in range(0, len(der), 16):
-        cert_rows.append('      \"%s\"' %
-                         ''.join(["\\x%02x" % ord(x)
-                                  for x in der[x:x+16]]))
-    args['certData'] = '\n'.join(cert_rows)
 
-    output.write("""\
-   {
-      "%(key_name)s",
+def process_key(output, key):
+    """\
+    Format a public key from a certificate as RawRSAKey structure.
+    """
+    pem_file = get_pem(key)
+    if pem_file is None:
+        raise ValueError("Key %s does not exist" % key)
+    der, info = load_cert(os.path.realpath(pem_file))
+
+    # Escape the whole certificate at once, then split it into rows of
+    # 16 bytes (64 characters).
+    escaped = ''.join(map(hex_escapes.__getitem__, der))
+    cert_rows = [escaped[x:x+64] for x in range(0, len(escaped), 64)]
+    cert_data = '      "' + '"\n      "'.join(cert_rows) + '"'
+
+    output.write(f"""\
+   {{
+      "{key}",
       (const unsigned char *)
-%(certData)s,
-      %(certLength)s,
-      %(modulusStart)s, %(modulusLength)s,
-      %(exponentStart)s, %(exponentLength)s,
-      MBEDTLS_MD_%(hash)s,
+{cert_data},
+      {info['certLength']},
+      {info['modulusStart']}, {info['modulusLength']},
+      {info['exponentStart']}, {info['exponentLength']},
+      MBEDTLS_MD_{info['hash']},
       false,
-      { 0 }
-   },
-""" % args)
+      {{ 0 }}
+   }},
+""")
 
 
 def main(inputFile, output):
     signinfo = json.load(inputFile)
     if len(sys.argv) > 1 and sys.argv[1] == '--list':
-        for keys in signinfo.values():
-            for key in keys:
-                print("%s" % get_pem(key))
+        sys.stdout.write(''.join('%s\n' % get_pem(key)
+                                 for keys in signinfo.values()
+                                 for key in keys))
         sys.exit(0)
 
+    # Build the whole file in memory and write it out at once.
+    buf = io.StringIO()
     args = dict(cmd=sys.argv[0], year=time.strftime('%Y'))
-    output.write('''\
+    buf.write('''\
 /*******************************************************************************
  * Copyright (c) %(year)s VMware, Inc.  All rights reserved.
  * SPDX-License-Identifier: GPL-2.0
@@ -220,12 +193,12 @@ RawRSACert certs[] = {
     # Sort reverse, so 'test' is before 'official', like in original code
     for condition, keys in sorted(signinfo.items(), reverse=True):
         if condition:
-            output.write('#if defined(%s)\n' % condition)
+            buf.write('#if defined(%s)\n' % condition)
         for key in keys:
-            process_key(output, key)
+            process_key(buf, key)
         if condition:
-            output.write('#endif /* defined(%s) */\n' % condition)
-    output.write('''\
+            buf.write('#endif /* defined(%s) */\n' % condition)
+    buf.write('''\
    {
       NULL,
       NULL, 0,
@@ -239,6 +212,7 @@ RawRSACert certs[] = {
 
 #endif /* SECURE_BOOT */
 ''')
+    output.write(buf.getvalue())
     return 0
 
 if __name__ == '__main__':
@@ -13,8 +13,34 @@
 
 import sys
 import os
+import concurrent.futures
+import functools
+import shutil
+import struct
 import subprocess
 
+# Local signing can be done in-process when asn1crypto and cryptography
+# are available.
+try:
+   from asn1crypto import algos, cms, core, pem, x509
+   from cryptography.hazmat.primitives import hashes, serialization
+   from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:
+   cms = None
+else:
+   # Authenticode structures, which asn1crypto does not define.
+   class SpcAttributeTypeAndOptionalValue(core.Sequence):
+      _fields = [
+         ('type', core.ObjectIdentifier),
+         ('value', core.Any),
+      ]
+
+   class SpcIndirectDataContent(core.Sequence):
+      _fields = [
+         ('data', SpcAttributeTypeAndOptionalValue),
+         ('message_digest', algos.DigestInfo),
+      ]
+
 # Pick up optional environment variables.
 official = os.getenv('SIGN_RELEASE_BINARIES') == '1'
 sbsign = os.getenv('SBSIGN') or 'sbsign'
@@ -26,21 +52,148 @@ sigcache = topdir + '/sigcache'
 localkeys = os.getenv('LOCALKEYS') or topdir + '/localkeys'
 uefi_ca_cert = topdir + '/env/MicCorUEFCA2011_2011-06-27.pem'
 
+# Sign with test keys in-process, unless SBSIGN explicitly selects a
+# signing tool or the required packages are missing.
+inprocess_sign = cms is not None and not os.getenv('SBSIGN')
+
 # Construct filename for a detached signature.
 def signame(iname, key):
    return iname + '@' + key + '.tmp'
 
-# Sign locally with sbsigntool.  Usable only with test keys, since it
-# requires access to the private key as a file.  Creates detached
-# signature file signame(iname, key).
+# Compute the Authenticode SHA-256 digest of a PE image: the whole file
+# except the checksum field, the certificate table directory entry and
+# the certificate table itself, with sections hashed in file order.
+def authenticode_digest(data):
+   pe = struct.unpack_from('<I', data, 0x3c)[0]
+   if data[pe:pe + 4] != b'PE\0\0':
+      raise ValueError('Not a PE image')
+   nsections, = struct.unpack_from('<H', data, pe + 6)
+   opt_size, = struct.unpack_from('<H', data, pe + 20)
+   opt = pe + 24
+   magic, = struct.unpack_from('<H', data, opt)
+   if magic == 0x10b:
+      datadir = opt + 96
+   elif magic == 0x20b:
+      datadir = opt + 112
+   else:
+      raise ValueError('Unknown PE optional header magic %#x' % magic)
+   headers_size, = struct.unpack_from('<I', data, opt + 60)
+   checksum = opt + 64
+   certdir = datadir + 4 * 8
+   cert_size, = struct.unpack_from('<I', data, certdir + 4)
+
+   # The certificate table is 8-byte aligned, and any padding inserted
+   # ahead of it when attaching a signature is covered by the digest.
+   if cert_size == 0 and len(data) % 8 != 0:
+      data += bytes(8 - len(data) % 8)
+
+   digest = hashes.Hash(hashes.SHA256())
+   digest.update(data[:checksum])
+   digest.update(data[checksum + 4:certdir])
+   digest.update(data[certdir + 8:headers_size])
+   hashed = headers_size
+
+   sections = []
+   for i in range(nsections):
+      section = opt + opt_size + 40 * i
+      size, offset = struct.unpack_from('<II', data, section + 16)
+      if size != 0:
+         sections.append((offset, size))
+   for offset, size in sorted(sections):
+      digest.update(data[offset:offset + size])
+      hashed += size
+
+   if len(data) > hashed + cert_size:
+      digest.update(data[hashed:len(data) - cert_size])
+   return digest.finalize()
+
+# Authenticode object identifiers.
+spc_indirect_data_oid = '1.3.6.1.4.1.311.2.1.4'
+spc_sp_opus_info_oid = '1.3.6.1.4.1.311.2.1.12'
+spc_pe_image_data_oid = '1.3.6.1.4.1.311.2.1.15'
+
+# Fixed SpcPeImageData value used by signing tools: no flags and an
+# "<<<Obsolete>>>" file link.
+spc_pe_image_data = b'\x30\x25\x03\x01\x00\xa0\x20\xa2\x1e\x80\x1c' + \
+                    '<<<Obsolete>>>'.encode('utf-16-be')
+
+# Sign locally.  Usable only with test keys, since it requires access to
+# the private key as a file.  Creates detached signature file
+# signame(iname, key), a PKCS#7 SignedData holding an Authenticode
+# SpcIndirectDataContent.
 def localsign(iname, key):
    k = localkeys + '/' + key + '/' + key
-   subprocess.check_call([sbsign,
-                          '--key', k + '.key',
-                          '--cert', k + '.cert',
-                          '--detached',
-                          '--output', signame(iname, key),
-                          iname])
+   if not inprocess_sign:
+      subprocess.check_call([sbsign,
+                             '--key', k + '.key',
+                             '--cert', k + '.cert',
+                             '--detached',
+                             '--output', signame(iname, key),
+                             iname])
+      return
+
+   with open(k + '.key', 'rb') as f:
+      priv = serialization.load_pem_private_key(f.read(), None)
+   with open(k + '.cert', 'rb') as f:
+      _, _, cert_der = pem.unarmor(f.read())
+   cert = x509.Certificate.load(cert_der)
+   with open(iname, 'rb') as f:
+      image = f.read()
+
+   sha256 = {'algorithm': 'sha256'}
+   spc = SpcIndirectDataContent({
+      'data': {
+         'type': spc_pe_image_data_oid,
+         'value': core.Any.load(spc_pe_image_data),
+      },
+      'message_digest': {
+         'digest_algorithm': sha256,
+         'digest': authenticode_digest(image),
+      },
+   })
+
+   # Authenticode digests the SpcIndirectDataContent without its
+   # outer tag and length.
+   spc_digest = hashes.Hash(hashes.SHA256())
+   spc_digest.update(spc.contents)
+   signed_attrs = cms.CMSAttributes([
+      {'type': 'content_type',
+       'values': [spc_indirect_data_oid]},
+      {'type': spc_sp_opus_info_oid,
+       'values': [core.Any.load(b'\x30\x00')]},
+      {'type': 'message_digest',
+       'values': [spc_digest.finalize()]},
+   ])
+   signature = priv.sign(signed_attrs.dump(), padding.PKCS1v15(),
+                         hashes.SHA256())
+
+   signed_data = cms.SignedData({
+      'version': 'v1',
+      'digest_algorithms': [sha256],
+      'encap_content_info': {
+         'content_type': spc_indirect_data_oid,
+         # asn1crypto drops the [0] EXPLICIT tag of a PKCS#7 content
+         # given as a plain value, so apply it here.
+         'content': spc.retag({'explicit': 0}),
+      },
+      'certificates': [cert],
+      'signer_infos': [{
+         'version': 'v1',
+         'sid': cms.SignerIdentifier({
+            'issuer_and_serial_number': {
+               'issuer': cert.issuer,
+               'serial_number': cert.serial_number,
+            },
+         }),
+         'digest_algorithm': sha256,
+         'signed_attrs': signed_attrs,
+         'signature_algorithm': {'algorithm': 'rsassa_pkcs1v15'},
+         'signature': signature,
+      }],
+   })
+   with open(signame(iname, key), 'wb') as f:
+      f.write(cms.ContentInfo({'content_type': 'signed_data',
+                               'content': signed_data}).dump())
 
 # Sign remotely with authenticodesignc.  Usable with official keys.
 # Creates detached signature file signame(iname, key).
@@ -56,20 +209,17 @@ def remotesign(iname, key):
                                 '--detach', signame(iname, key), tmpname])
    os.remove(tmpname)
 
-# Obtain the cached UEFI-CA signature.
+# Construct filename for a cached UEFI-CA signature.
+def cachedname(iname):
+   return sigcache + '/' + os.path.basename(iname)
+
+# Obtain the cached UEFI-CA signature, which must exist.  Returns False
+# if making this signed target should be skipped.
 def cachedsign(iname):
    key = 'uefi_ca'
-   cname = sigcache + '/' + os.path.basename(iname)
+   cname = cachedname(iname)
    sname = signame(iname, key)
 
-   # Check that a cached signature exists.  If not, quietly skip
-   # making this signed target.  Needed because the Makefiles are not
-   # smart enough to skip trying to sign test binaries that we haven't
-   # asked UEFI-CA to sign.
-   if not os.path.isfile(cname):
-      print('Skipped signing with %s; no cached signature' % key)
-      exit(0)
-
    subprocess.check_call([sbattach, '--detach', sname, cname])
 
    # Verify that the cached signature is still correct for this build.
@@ -82,16 +232,16 @@ def cachedsign(iname):
                                '--cert', uefi_ca_cert,
                                iname])
    except subprocess.CalledProcessError as e:
-      if e.output == 'Signature verification failed\n':
+      if e.output == b'Signature verification failed\n':
          print('''Skipped signing with %s; cached signature is invalid
 *** This build cannot be used in an official ESXi release.
 *** See https://wiki.eng.vmware.com/ESXSecureBoot/UEFI-CA-Signing
 ''' % key)
-         cleanup(iname, [key])
-         exit(0)
+         return False
       else:
-         print(e.output)
+         print(e.output.decode('utf-8', 'replace'))
          raise e
+   return True
 
 # Clean up temporary detached signature files
 def cleanup(iname, keys):
@@ -109,7 +259,9 @@ if len(sys.argv) > 3:
 else:
    oname = iname + '-' + sys.argv[1]
 
-# Generate a detached signature for each key.
+# Generate a detached signature for each key.  Each signing operation
+# writes its own signature file, so they can all run concurrently.
+tasks = []
 for key in keys:
    vmware = key.find('vmware') >= 0
    uefi = key.find('uefi') >= 0
@@ -118,17 +270,45 @@ for key in keys:
       cleanup(iname, keys)
       exit(0)
    if uefi:
-      cachedsign(iname)
+      # Check that a cached signature exists.  If not, quietly skip
+      # making this signed target, before any other key is signed.
+      # Needed because the Makefiles are not smart enough to skip
+      # trying to sign test binaries that we haven't asked UEFI-CA to
+      # sign.
+      if not os.path.isfile(cachedname(iname)):
+         print('Skipped signing with %s; no cached signature' % key)
+         cleanup(iname, keys)
+         exit(0)
+      tasks.append(functools.partial(cachedsign, iname))
    elif vmware:
-      remotesign(iname, key)
+      tasks.append(functools.partial(remotesign, iname, key))
    else:
-      localsign(iname, key)
+      tasks.append(functools.partial(localsign, iname, key))
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+   futures = [pool.submit(task) for task in tasks]
+   results = [future.result() for future in futures]
+if False in results:
+   cleanup(iname, keys)
+   exit(0)
+
+# Attach the signatures.  Like 'cp -f', remove any existing output
+# file first rather than writing through it, unless it is the input
+# itself; shutil.copy then refuses to copy it, as cp does.
+try:
+   if not os.path.samefile(iname, oname):
+      os.unlink(oname)
+except FileNotFoundError:
+   pass
+shutil.copy(iname, oname)
 
-# Attach the signatures
-subprocess.check_call(['cp', '-f', iname, oname])
+# subprocess only uses posix_spawn() instead of fork() and exec() when
+# given a path to the executable and close_fds=False.
+sbattach_path = shutil.which(sbattach) or sbattach
 for key in keys:
-   subprocess.check_call([sbattach,
+   subprocess.check_call([sbattach_path,
                           '--attach', signame(iname, key),
-                          oname])
+                          oname],
+                         close_fds=False)
 
 cleanup(iname, keys)